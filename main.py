@@ -1,23 +1,31 @@
 import os
-from datetime import datetime, time, timedelta
+from datetime import datetime, time
+from functools import lru_cache
+from pathlib import Path
+from time import monotonic, time as unix_time
 from typing import Annotated, Any
 
+import jinja2
+import orjson
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 import uvicorn
-from fastapi import Depends, FastAPI, Form, HTTPException, Request, status
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse
+from fastapi import Depends, FastAPI, Form, HTTPException, Request, Response, status
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError as JWTError
 from passlib.context import CryptContext
 
 from models.base import Base
 from models.camp import Squad
 from models.metro import Line, Station
 from models.money import (
+    AnotherExchangeStations,
     Deposit,
     ExchangeRequest,
+    OriginExchangeStations,
     RequestStatus,
     Transaction,
     TransactionStatus,
@@ -29,9 +37,20 @@ from models.users import Camper, Counselor, RegisterCode, Roles, Token, User
 url = os.getenv("DATABASE_URL")
 if not url:
     raise RuntimeError("DATABASE_URL is not set")
-engine = sa.create_engine(url)
-Base.metadata.create_all(bind=engine)
-SessionLocal = so.sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = sa.create_engine(
+    url,
+    pool_size=int(os.getenv("DB_POOL_SIZE", 25)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 25)),
+    pool_pre_ping=True,
+    pool_recycle=600,
+)
+# create_all на каждом старте — это по round-trip интроспекции на таблицу;
+# на проде можно выключить через DB_CREATE_ALL=0, когда схема уже создана
+if os.getenv("DB_CREATE_ALL", "1") == "1":
+    Base.metadata.create_all(bind=engine)
+SessionLocal = so.sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
 
 
 def get_db():
@@ -42,10 +61,24 @@ def get_db():
         db.close()
 
 
-app = FastAPI()  # docs_url=None, redoc_url=None, openapi_url=None
+app = FastAPI(
+    default_response_class=ORJSONResponse
+)  # docs_url=None, redoc_url=None, openapi_url=None
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# без auto_reload Jinja не делает os.stat на шаблон при каждом рендере,
+# а bytecode-кэш переживает перезапуск воркера — первый рендер не парсит шаблон
+templates = Jinja2Templates(
+    directory="templates",
+    auto_reload=os.getenv("TEMPLATES_AUTO_RELOAD") == "1",
+    cache_size=-1,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(),
+)
+# прогреваем все шаблоны сразу, чтобы компиляцию не оплачивал первый запрос
+for _name in templates.env.list_templates(filter_func=lambda n: n.endswith(".html")):
+    templates.env.get_template(_name)
 pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=8)
+# прогреваем бэкенд bcrypt и кэш dummy-хэша, чтобы не платить за это в первом запросе
+pwd_context.dummy_verify()
 
 available_after = time(20, 28)
 available_until = time(23, 37)
@@ -56,18 +89,20 @@ if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY is not set")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
+TOKEN_TTL_SECONDS = ACCESS_TOKEN_EXPIRE_DAYS * 24 * 60 * 60
 
 
 def create_access_token(username: str):
-    data: dict[str, Any] = {"username": username}
-
-    expire = datetime.utcnow() + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    data.update({"exp": expire})
+    data: dict[str, Any] = {
+        "username": username,
+        "exp": int(unix_time()) + TOKEN_TTL_SECONDS,
+    }
     encoded_jwt = jwt.encode(data, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def parse_token(token: str) -> Token | None:
+@lru_cache(maxsize=4096)
+def _decode_token(token: str) -> Token | None:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         tkn = Token(**payload)
@@ -77,142 +112,274 @@ def parse_token(token: str) -> Token | None:
         return None
 
 
+def parse_token(token: str) -> Token | None:
+    # HMAC+base64 на каждый запрос не нужны: подпись токена не меняется,
+    # так что результат декодирования кэшируем по самой строке cookie.
+    # exp проверяется заново при каждом обращении — кэш его не обходит.
+    tkn = _decode_token(token)
+    if tkn and not tkn.is_valid():
+        return None
+    return tkn
+
+
+# горячие запросы собираем один раз на старте, а не на каждый вызов
+USER_BY_USERNAME_Q = sa.select(User).where(User.username == sa.bindparam("username"))
+SQUAD_BY_NUMBER_Q = sa.select(Squad).where(Squad.number == sa.bindparam("number"))
+STATION_FOR_PURCHASE_Q = (
+    sa.select(Station.name, Station.initial_price, Station.owner_id, Squad.number)
+    .outerjoin(Squad, Station.owner_id == Squad.id)
+    .where(Station.id == sa.bindparam("station_id"))
+)
+WALLET_BY_SQUAD_Q = sa.select(Wallet).where(Wallet.squad_id == sa.bindparam("squad_id"))
+
+
+def get_user_by_token(db: so.Session, token_str: str | None) -> User | None:
+    if not token_str:
+        return None
+    token = parse_token(token_str)
+    if not token:
+        return None
+    return db.scalars(USER_BY_USERNAME_Q, {"username": token.username}).one_or_none()
+
+
+def current_user(request: Request, db: so.Session = Depends(get_db)) -> User | None:
+    # FastAPI кэширует результат зависимости в рамках одного запроса,
+    # так что пользователь читается из базы максимум один раз
+    return get_user_by_token(db, request.cookies.get("token"))
+
+
+# в разработке превращает случайную ленивую загрузку на страницах чтения
+# в ошибку вместо незаметных N+1 запросов
+RAISE_ON_LAZY_LOAD = os.getenv("RAISE_ON_LAZY_LOAD") == "1"
+
+
+def read_page_options(*options: so.interfaces.LoaderOption):
+    if RAISE_ON_LAZY_LOAD:
+        return (*options, so.raiseload("*"))
+    return options
+
+
+# тело 403 всегда одно и то же — сериализуем его один раз на старте;
+# сам Response на каждый вызов свой, т.к. заголовки мутируются при отправке
+_NO_PERMISSION_BODY = orjson.dumps({"message": "No permission"})
+
+
+def no_permission_response() -> Response:
+    return Response(
+        content=_NO_PERMISSION_BODY,
+        status_code=status.HTTP_403_FORBIDDEN,
+        media_type="application/json",
+    )
+
+
+# анонимные страницы «/» и «/bought-stations» меняются только при покупках,
+# сделках и начислениях — готовый HTML держим в памяти и сбрасываем при записи
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", 30))
+_page_cache: dict[str, tuple[int, float, bytes]] = {}
+_page_cache_version = 0
+
+
+def invalidate_page_cache():
+    global _page_cache_version
+    _page_cache_version += 1
+
+
+def cached_html(key: str, render) -> HTMLResponse:
+    if PAGE_CACHE_TTL <= 0:
+        return render()
+    entry = _page_cache.get(key)
+    now = monotonic()
+    if entry and entry[0] == _page_cache_version and entry[1] > now:
+        return HTMLResponse(entry[2])
+    response = render()
+    _page_cache[key] = (_page_cache_version, now + PAGE_CACHE_TTL, response.body)
+    return response
+
+
+# склонение по последним двум цифрам; 11–14 — всегда «станций»
+_STATIONS_SUFFIXES = (
+    "станций", "станция", "станции", "станции", "станции",
+    "станций", "станций", "станций", "станций", "станций",
+)
+
+
 def get_stations_str(number_of_stations: int) -> str:
-    match number_of_stations % 10:
-        case 0 | 1:
-            return str(number_of_stations) + " станция"
-        case 2 | 3 | 4:
-            return str(number_of_stations) + " станции"
-        case 5 | 6 | 7 | 8 | 9:
-            return str(number_of_stations) + " станций"
-        case _:
-            return "неправильный остаток от деления на 10"
+    if 11 <= number_of_stations % 100 <= 14:
+        return f"{number_of_stations} станций"
+    return f"{number_of_stations} {_STATIONS_SUFFIXES[number_of_stations % 10]}"
 
 
 @app.get(path="/", response_class=HTMLResponse)
 def get_root_page(request: Request, db: so.Session = Depends(get_db)):
-    lines_q = sa.select(Line).order_by(Line.order_number)
-    lines = list(db.scalars(lines_q))
+    def render():
+        # index.html показывает только имя/номер/коэффициент линии и имя/баланс
+        # состава — остальные колонки не тянем
+        lines_q = (
+            sa.select(Line)
+            .options(so.load_only(Line.name, Line.number, Line.full_line_coef))
+            .order_by(Line.order_number)
+        )
+        lines = list(db.scalars(lines_q))
+
+        squads_q = sa.select(Squad).options(
+            *read_page_options(
+                so.load_only(Squad.name),
+                so.joinedload(Squad.wallet).load_only(Wallet.current_balance),
+            )
+        )
+        squads = list(db.scalars(squads_q))
 
-    squads_q = sa.select(Squad)
-    squads = list(db.scalars(squads_q))
+        return templates.TemplateResponse(
+            "index.html", {"request": request, "lines": lines, "squads": squads}
+        )
 
-    return templates.TemplateResponse(
-        "index.html", {"request": request, "lines": lines, "squads": squads}
-    )
+    return cached_html("index", render)
 
 
 @app.get("/bought-stations", response_class=HTMLResponse)
 def get_bought_stations_page(request: Request, db: so.Session = Depends(get_db)):
-    bought_stations_q = sa.select(Station).where(Station.owner_id != None)
-    bought_stations = list(db.scalars(bought_stations_q))
-    return templates.TemplateResponse(
-        "bought-stations.html",
-        {"request": request, "bought_stations": bought_stations},
-    )
+    def render():
+        bought_stations_q = (
+            sa.select(Station)
+            .where(Station.owner_id.is_not(None))
+            .options(*read_page_options(so.joinedload(Station.line)))
+            .execution_options(yield_per=100)
+        )
+        bought_stations = db.scalars(bought_stations_q)
+        bought_count_q = (
+            sa.select(sa.func.count())
+            .select_from(Station)
+            .where(Station.owner_id.is_not(None))
+        )
+        bought_count = db.scalar(bought_count_q)
+        return templates.TemplateResponse(
+            "bought-stations.html",
+            {
+                "request": request,
+                "bought_stations": bought_stations,
+                "bought_count": bought_count,
+            },
+        )
+
+    return cached_html("bought-stations", render)
 
 
 @app.get(path="/squad/{number}", response_class=HTMLResponse)
 def get_squad_info(request: Request, number: int, db: so.Session = Depends(get_db)):
-    squad_q = sa.select(Squad).filter_by(number=number)
-    squad = db.scalars(squad_q).one_or_none()
-    if not squad:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Состав с таким номером не найден",
+    def render():
+        squad_q = (
+            sa.select(Squad)
+            .filter_by(number=number)
+            .options(
+                *read_page_options(
+                    so.joinedload(Squad.wallet),
+                    so.selectinload(Squad.stations).joinedload(Station.line),
+                )
+            )
         )
-    return templates.TemplateResponse(
-        "squad.html", {"request": request, "squad": squad}
-    )
+        squad = db.scalars(squad_q).one_or_none()
+        if not squad:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Состав с таким номером не найден",
+            )
+        return templates.TemplateResponse(
+            "squad.html", {"request": request, "squad": squad}
+        )
+
+    return cached_html(f"squad/{number}", render)
 
 
 @app.get(path="/line/{number}", response_class=HTMLResponse)
 def get_line_info(request: Request, number: str, db: so.Session = Depends(get_db)):
-    line_q = sa.select(Line).filter_by(number=number)
-    line = db.scalars(line_q).one_or_none()
-    if not line:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Линия с таким номером не найдена",
+    def render():
+        line_q = (
+            sa.select(Line)
+            .filter_by(number=number)
+            .options(*read_page_options(so.selectinload(Line.stations)))
+        )
+        line = db.scalars(line_q).one_or_none()
+        if not line:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Линия с таким номером не найдена",
+            )
+        return templates.TemplateResponse(
+            "line.html", {"request": request, "line": line}
         )
-    return templates.TemplateResponse("line.html", {"request": request, "line": line})
+
+    return cached_html(f"line/{number}", render)
 
 
 @app.get(path="/login", response_class=HTMLResponse)
-def get_auth_page(request: Request, db: so.Session = Depends(get_db)):
-    token_str = request.cookies.get("token")
-    if token_str:
-        token = parse_token(token_str)
-        if token and token.is_valid():
-            user_q = sa.select(User).filter_by(username=token.username)
-            user = db.scalars(user_q).one_or_none()
-            if user:
-                return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
-    response = templates.TemplateResponse("login.html", {"request": request})
+def get_auth_page(request: Request, user: User | None = Depends(current_user)):
+    if user:
+        return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
+    # сама страница логина статична — берём готовый HTML из кэша,
+    # а куку чистим уже на конкретном ответе
+    response = cached_html(
+        "login", lambda: templates.TemplateResponse("login.html", {"request": request})
+    )
     response.delete_cookie("token")
     return response
 
 
-@app.post(path="/login", response_class=JSONResponse)
+@app.post(path="/login", response_class=ORJSONResponse)
 def login(
     request: Request,
     username: Annotated[str, Form()],
     password: Annotated[str, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    token_str = request.cookies.get("token")
-    if token_str:
-        token = parse_token(token_str)
-        if token and token.is_valid():
-            user_q = sa.select(User).filter_by(username=token.username)
-            user = db.scalars(user_q).one_or_none()
-            if user:
-                return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
-
-    user_q = sa.select(User).filter_by(username=username)
-    user = db.scalars(user_q).one_or_none()
+    if user:
+        return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
+
+    user = db.scalars(USER_BY_USERNAME_Q, {"username": username}).one_or_none()
     if not user:
         pwd_context.dummy_verify()
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_401_UNAUTHORIZED,
             content={"message": "Неверный логин или пароль"},
         )
     if not pwd_context.verify(password, user.pwd_hash):
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_401_UNAUTHORIZED,
             content={"message": "Неверный логин или пароль"},
         )
-    response = JSONResponse(
+    response = ORJSONResponse(
         status_code=status.HTTP_200_OK,
         content={"message": "Аутентификация прошла успешно"},
     )
     token = create_access_token(user.username)
-    response.set_cookie("token", token, expires=ACCESS_TOKEN_EXPIRE_DAYS * 24 * 60 * 60)
+    response.set_cookie("token", token, expires=TOKEN_TTL_SECONDS)
     return response
 
 
 @app.get(path="/register", response_class=HTMLResponse)
-def get_register_page(request: Request, db: so.Session = Depends(get_db)):
-    token_str = request.cookies.get("token")
-    if token_str:
-        token = parse_token(token_str)
-        if token and token.is_valid():
-            user_q = sa.select(User).filter_by(username=token.username)
-            user = db.scalars(user_q).one_or_none()
-            if user:
-                return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
-
-    roles = [Roles.COUNSELOR, Roles.CAMPER]
-    squads_q = sa.select(Squad)
-    squads = list(db.scalars(squads_q))
-    response = templates.TemplateResponse(
-        "register.html", {"request": request, "roles": roles, "squads": squads}
-    )
+def get_register_page(
+    request: Request,
+    db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
+):
+    if user:
+        return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
+
+    def render():
+        roles = [Roles.COUNSELOR, Roles.CAMPER]
+        # register.html проходит по составам один раз — материализовать список незачем
+        squads_q = sa.select(Squad)
+        squads = db.scalars(squads_q)
+        return templates.TemplateResponse(
+            "register.html", {"request": request, "roles": roles, "squads": squads}
+        )
+
+    response = cached_html("register", render)
     response.delete_cookie("token")
     return response
 
 
-@app.post(path="/register", response_class=JSONResponse)
+@app.post(path="/register", response_class=ORJSONResponse)
 def register(
     request: Request,
     username: Annotated[str, Form()],
@@ -221,39 +388,38 @@ def register(
     role_str: Annotated[str, Form()],
     squad_number: Annotated[int, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    token_str = request.cookies.get("token")
-    if token_str:
-        token = parse_token(token_str)
-        if token and token.is_valid():
-            user_q = sa.select(User).filter_by(username=token.username)
-            user = db.scalars(user_q).one_or_none()
-            if user:
-                return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
+    if user:
+        return RedirectResponse("/profile", status_code=status.HTTP_302_FOUND)
 
     role = Roles[role_str]
 
-    user_q = sa.select(User).filter_by(username=username)
-    user = db.scalars(user_q).one_or_none()
-    if user:
-        return JSONResponse(
+    username_taken = db.scalar(sa.select(sa.exists().where(User.username == username)))
+    if username_taken:
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Пользователь с таким логином уже существует"},
         )
 
-    squad_q = sa.select(Squad).filter_by(number=squad_number)
-    squad = db.scalars(squad_q).one_or_none()
+    squad = db.scalars(SQUAD_BY_NUMBER_Q, {"number": squad_number}).one_or_none()
     if not squad:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Состава с таким номером не найдено"},
         )
 
-    reg_code_q = sa.select(RegisterCode).filter_by(code=code)
-    reg_code = db.scalars(reg_code_q).one_or_none()
+    # из кода регистрации нужны только роль и номер целевого состава —
+    # целую строку с ленивыми связями не поднимаем
+    reg_code_q = (
+        sa.select(RegisterCode.target_role, Squad.number)
+        .join(Squad, Squad.id == RegisterCode.target_squad_id)
+        .where(RegisterCode.code == code)
+    )
+    reg_code = db.execute(reg_code_q).one_or_none()
 
     if not reg_code:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Код не найден"},
         )
@@ -261,71 +427,85 @@ def register(
     match role:
         case Roles.COUNSELOR:
             if reg_code.target_role != Roles.COUNSELOR:
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     content={
                         "message": "Данный код не предназначен для регистрации с данной ролью"
                     },
                 )
-            if reg_code.target_squad.number != squad.number:
-                return JSONResponse(
+            if reg_code.number != squad.number:
+                return ORJSONResponse(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     content={"message": "Данный код предназначен для другого состава"},
                 )
             new_user = Counselor(username, pwd_context.hash(password), squad)
         case Roles.CAMPER:
             if reg_code.target_role != Roles.CAMPER:
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     content={
                         "message": "Данный код не предназначен для регистрации с данной ролью"
                     },
                 )
-            if reg_code.target_squad.number != squad.number:
-                return JSONResponse(
+            if reg_code.number != squad.number:
+                return ORJSONResponse(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     content={"message": "Данный код предназначен для другого состава"},
                 )
             new_user = Camper(username, pwd_context.hash(password), squad)
         case _:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=status.HTTP_501_NOT_IMPLEMENTED,
                 content={"message": "Неизвестная роль."},
             )
     db.add(new_user)
     db.commit()
-    response = JSONResponse(
+    response = ORJSONResponse(
         status_code=status.HTTP_201_CREATED,
         content={"message": "Регистрация прошла успешно"},
     )
     token = create_access_token(username)
-    response.set_cookie("token", token, expires=ACCESS_TOKEN_EXPIRE_DAYS * 24 * 60 * 60)
+    response.set_cookie("token", token, expires=TOKEN_TTL_SECONDS)
     return response
 
 
 @app.get(path="/profile", response_class=HTMLResponse)
-def get_profile_page(request: Request, db: so.Session = Depends(get_db)):
+def get_profile_page(
+    request: Request,
+    db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
+):
     login_redirect = RedirectResponse("/login", status_code=status.HTTP_302_FOUND)
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return login_redirect
-    token = parse_token(token_str)
-    if not token:
-        return login_redirect
-    if not token.is_valid():
-        return login_redirect
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
         return login_redirect
 
-    squads_q = sa.select(Squad)
-    squads = list(db.scalars(squads_q))
-
     match user.role:
         case Roles.ADMIN | Roles.METHODIST:
-            exReqs_q = sa.select(ExchangeRequest)
+            # admin.html считает полный баланс каждого состава, так что
+            # прогружаем весь нужный граф заранее, а не по одной связи за запрос
+            squads_q = sa.select(Squad).options(
+                *read_page_options(
+                    so.joinedload(Squad.wallet),
+                    so.selectinload(Squad.stations)
+                    .joinedload(Station.line)
+                    .selectinload(Line.stations)
+                    .joinedload(Station.owner),
+                )
+            )
+            squads = list(db.scalars(squads_q))
+
+            exReqs_q = sa.select(ExchangeRequest).options(
+                *read_page_options(
+                    so.joinedload(ExchangeRequest.origin_squad),
+                    so.joinedload(ExchangeRequest.another_squad),
+                    so.selectinload(ExchangeRequest.origin_squad_stations).joinedload(
+                        OriginExchangeStations.station
+                    ),
+                    so.selectinload(ExchangeRequest.another_squad_stations).joinedload(
+                        AnotherExchangeStations.station
+                    ),
+                )
+            )
             exReqs = list(db.scalars(exReqs_q))
             return templates.TemplateResponse(
                 "/profile/admin.html",
@@ -333,14 +513,59 @@ def get_profile_page(request: Request, db: so.Session = Depends(get_db)):
             )
         case Roles.COUNSELOR:
             user_2: Counselor = user  # type: ignore
+            # counselor.html обходит станции отряда, полный баланс и обе пачки
+            # заявок на обмен — прогружаем весь граф заранее, без ленивых запросов
+            squad_graph_q = (
+                sa.select(Squad)
+                .where(Squad.id == user_2.squad_id)
+                .options(
+                    *read_page_options(
+                        so.joinedload(Squad.wallet),
+                        so.selectinload(Squad.stations)
+                        .joinedload(Station.line)
+                        .selectinload(Line.stations)
+                        .joinedload(Station.owner),
+                        so.selectinload(Squad.incoming_exchange_requests).options(
+                            so.joinedload(ExchangeRequest.origin_squad),
+                            so.selectinload(
+                                ExchangeRequest.origin_squad_stations
+                            ).joinedload(OriginExchangeStations.station),
+                            so.selectinload(
+                                ExchangeRequest.another_squad_stations
+                            ).joinedload(AnotherExchangeStations.station),
+                        ),
+                        so.selectinload(Squad.outgoing_exchange_requests).options(
+                            so.joinedload(ExchangeRequest.another_squad),
+                            so.selectinload(
+                                ExchangeRequest.origin_squad_stations
+                            ).joinedload(OriginExchangeStations.station),
+                            so.selectinload(
+                                ExchangeRequest.another_squad_stations
+                            ).joinedload(AnotherExchangeStations.station),
+                        ),
+                    )
+                )
+            )
+            db.scalars(squad_graph_q).one()
             stations_str: str = get_stations_str(len(user_2.squad.stations))
+            squads_q = sa.select(Squad)
+            squads = list(db.scalars(squads_q))
             squads.remove(user_2.squad)
 
-            free_stations_q = sa.select(Station).filter_by(owner_id=None)
+            free_stations_q = (
+                sa.select(Station)
+                .filter_by(owner_id=None)
+                .options(*read_page_options(so.joinedload(Station.line)))
+            )
             free_stations = list(db.scalars(free_stations_q))
 
-            transactions_q = sa.select(Transaction).filter_by(
-                wallet_id=user_2.squad.wallet.id, status=TransactionStatus.COMPLETED
+            transactions_q = (
+                sa.select(Transaction)
+                .filter_by(
+                    wallet_id=user_2.squad.wallet.id,
+                    status=TransactionStatus.COMPLETED,
+                )
+                .options(*read_page_options(so.joinedload(Transaction.made_by)))
             )
             transactions = list(db.scalars(transactions_q))
 
@@ -357,6 +582,21 @@ def get_profile_page(request: Request, db: so.Session = Depends(get_db)):
             )
         case Roles.CAMPER:
             user_2: Camper = user  # type: ignore
+            # camper.html тоже считает полный баланс через станции и линии
+            squad_graph_q = (
+                sa.select(Squad)
+                .where(Squad.id == user_2.squad_id)
+                .options(
+                    *read_page_options(
+                        so.joinedload(Squad.wallet),
+                        so.selectinload(Squad.stations)
+                        .joinedload(Station.line)
+                        .selectinload(Line.stations)
+                        .joinedload(Station.owner),
+                    )
+                )
+            )
+            db.scalars(squad_graph_q).one()
             stations_str: str = get_stations_str(len(user_2.squad.stations))
             return templates.TemplateResponse(
                 "/profile/camper.html",
@@ -376,109 +616,96 @@ def logout():
     return response
 
 
-@app.post(path="/buy-station", response_class=JSONResponse)
+@app.post(path="/buy-station", response_class=ORJSONResponse)
 def buy_station(
     request: Request,
     station_id: Annotated[int, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-    if not token.is_valid():
-        return no_permission
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
 
     if user.role != Roles.COUNSELOR:
-        return no_permission
+        return no_permission_response()
     # current_time = datetime.now().time()
     # if current_time < available_after or current_time > available_until:
-    #     return JSONResponse(
+    #     return ORJSONResponse(
     #         status_code=status.HTTP_400_BAD_REQUEST,
     #         content={
     #             "message": f"Покупка станций доступна с {available_after.strftime('%H:%M')} до {available_until.strftime('%H:%M')}."
     #         },
     #     )
     user_2: Counselor = user  # type: ignore
-    station_q = sa.select(Station).filter_by(id=station_id)
-    station = db.scalars(station_q).one_or_none()
-    if not station:
-        return JSONResponse(
+    station_row = db.execute(
+        STATION_FOR_PURCHASE_Q, {"station_id": station_id}
+    ).one_or_none()
+    if not station_row:
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Станция не найдена"},
         )
-    if station.owner_id:
-        return JSONResponse(
+    station_name, initial_price, owner_id, owner_number = station_row
+    if owner_id:
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={
-                "message": f"Станция уже куплена. Текущий владелец: {station.owner.number} состав"
+                "message": f"Станция уже куплена. Текущий владелец: {owner_number} состав"
             },
         )
     try:
         withdrawal = Withdrawal(
             wallet=user_2.squad.wallet,
-            amount=station.initial_price,
-            reason=f"Покупка станции {station.name}",
+            amount=initial_price,
+            reason=f"Покупка станции {station_name}",
             made_by=user_2,
         )
         db.add(withdrawal)
         withdrawal.execute()
-        station.owner_id = user_2.squad_id
-        db.merge(station)
+        # условие owner_id IS NULL защищает от гонки двух одновременных покупок
+        claim = db.execute(
+            sa.update(Station)
+            .where(Station.id == station_id, Station.owner_id.is_(None))
+            .values(owner_id=user_2.squad_id)
+        )
+        if claim.rowcount == 0:
+            db.rollback()
+            return ORJSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"message": "Станцию уже успел купить другой состав"},
+            )
         db.commit()
+        invalidate_page_cache()
         formatted_balance = "{:,}".format(user_2.squad.wallet.current_balance).replace(
             ",", " "
         )
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_201_CREATED,
             content={
-                "message": f"Станция {station.name} успешно куплена.",
+                "message": f"Станция {station_name} успешно куплена.",
                 "new_balance": formatted_balance,
             },
         )
     except ValueError as e:
         db.commit()
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST, content={"message": str(e)}
         )
 
 
-@app.post(path="/get-code", response_class=JSONResponse)
+@app.post(path="/get-code", response_class=ORJSONResponse)
 def get_code(
     request: Request,
     squad_id: Annotated[int, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-    if not token.is_valid():
-        return no_permission
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
 
-    target_squad_q = sa.select(Squad).filter_by(id=squad_id)
-    target_squad = db.scalars(target_squad_q).one_or_none()
+    target_squad = db.get(Squad, squad_id)
     if not target_squad:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Состава с таким номером не найдено"},
         )
@@ -488,68 +715,65 @@ def get_code(
     else:
         target_role = Roles.CAMPER
 
-    reg_code_q = sa.select(RegisterCode).filter_by(
+    code_q = sa.select(RegisterCode.code).filter_by(
         target_squad_id=squad_id, target_role=target_role
     )
-    reg_code = db.scalars(reg_code_q).one_or_none()
-    if not reg_code:
+    code = db.scalar(code_q)
+    if not code:
         reg_code = RegisterCode(user, target_squad, target_role=target_role)
         db.add(reg_code)
-        db.commit()
-    return JSONResponse(
+        try:
+            db.commit()
+            code = reg_code.code
+        except sa.exc.IntegrityError:
+            # параллельный запрос успел вставить код первым — просто читаем его
+            db.rollback()
+            code = db.scalar(code_q)
+    return ORJSONResponse(
         status_code=status.HTTP_201_CREATED,
         content={
-            "message": f"Код для регистрации в {target_squad.number} составе — {reg_code.code}."
+            "message": f"Код для регистрации в {target_squad.number} составе — {code}."
         },
     )
 
 
-@app.post(path="/get-squad-info", response_class=JSONResponse, status_code=201)
+@app.post(path="/get-squad-info", response_class=ORJSONResponse, status_code=201)
 def get_squad_information(
     request: Request,
     squad_id: Annotated[int, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-    if not token.is_valid():
-        return no_permission
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
     if user.role != Roles.COUNSELOR:
-        return no_permission
+        return no_permission_response()
 
-    squad_q = sa.select(Squad).filter_by(id=squad_id)
-    squad = db.scalars(squad_q).one_or_none()
-    if not squad:
-        return JSONResponse(
+    squad_exists = db.scalar(sa.select(Squad.id).filter_by(id=squad_id))
+    if not squad_exists:
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Состава с таким номером не найдено"},
         )
 
+    stations_q = (
+        sa.select(Station.id, Station.name, Line.number)
+        .join(Line, Station.line_id == Line.id)
+        .where(Station.owner_id == squad_id)
+    )
     station_ids: list[int] = []
     station_strings: list[str] = []
-    for station in squad.stations:
-        station_strings.append(f"{station.line.number} {station.name}")
-        station_ids.append(station.id)
+    for station_id, station_name, line_number in db.execute(stations_q):
+        station_strings.append(f"{line_number} {station_name}")
+        station_ids.append(station_id)
 
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_200_OK,
         content={"station_strings": station_strings, "station_ids": station_ids},
     )
 
 
-@app.post(path="/exchange", response_class=JSONResponse)
+@app.post(path="/exchange", response_class=ORJSONResponse)
 def exchange(
     request: Request,
     another_squad_id: Annotated[int, Form()],
@@ -558,25 +782,12 @@ def exchange(
     another_squad_station_ids: Annotated[list[int], Form()] = [],
     another_squad_withdraw: Annotated[int, Form()] = 0,
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-    if not token.is_valid():
-        return no_permission
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
     if user.role != Roles.COUNSELOR:
-        return no_permission
+        return no_permission_response()
 
     if (
         not your_squad_station_ids
@@ -584,15 +795,14 @@ def exchange(
         and not your_squad_withdraw
         and not another_squad_withdraw
     ):
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Зачем отправлять пустой запрос?"},
         )
 
-    another_squad_q = sa.select(Squad).filter_by(id=another_squad_id)
-    another_squad = db.scalars(another_squad_q).one_or_none()
+    another_squad = db.get(Squad, another_squad_id)
     if not another_squad:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Состава с таким номером не найдено"},
         )
@@ -608,7 +818,7 @@ def exchange(
     )
     db.add(exReq)
     db.commit()
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_201_CREATED,
         content={"message": "Заявка создана, теперь другой состав должен её принять"},
     )
@@ -619,41 +829,27 @@ def accept_exchange_request(
     request: Request,
     request_id: Annotated[int, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-    if not token.is_valid():
-        return no_permission
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
     if user.role != Roles.COUNSELOR:
-        return no_permission
+        return no_permission_response()
     user_2: Counselor = user  # type: ignore
 
-    exReq_q = sa.select(ExchangeRequest).filter_by(id=request_id)
-    exReq = db.scalars(exReq_q).one_or_none()
+    exReq = db.get(ExchangeRequest, request_id)
     if not exReq:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Заявка не найдена"},
         )
-    if exReq.another_squad != user_2.squad:
-        return JSONResponse(
+    if exReq.another_squad_id != user_2.squad_id:
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Вы не можете принять заявку другого состава"},
         )
     if exReq.status != RequestStatus.CREATED:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Заявка уже принята"},
         )
@@ -692,24 +888,35 @@ def accept_exchange_request(
             )
             db.add(deposit)
             deposit.execute()
-        for station in exReq.origin_squad_stations:
-            station.station.owner = exReq.another_squad
-        for station in exReq.another_squad_stations:
-            station.station.owner = exReq.origin_squad
+        origin_station_ids = [s.station_id for s in exReq.origin_squad_stations]
+        if origin_station_ids:
+            db.execute(
+                sa.update(Station)
+                .where(Station.id.in_(origin_station_ids))
+                .values(owner_id=exReq.another_squad_id)
+            )
+        another_station_ids = [s.station_id for s in exReq.another_squad_stations]
+        if another_station_ids:
+            db.execute(
+                sa.update(Station)
+                .where(Station.id.in_(another_station_ids))
+                .values(owner_id=exReq.origin_squad_id)
+            )
         exReq.status = RequestStatus.APPROVED
         db.commit()
+        invalidate_page_cache()
     except ValueError as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": str(e)},
         )
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_200_OK,
         content={"message": "Заявка принята"},
     )
 
 
-@app.post(path="/admin/add-balance", response_class=JSONResponse)
+@app.post(path="/admin/add-balance", response_class=ORJSONResponse)
 def add_balance(
     request: Request,
     squad_id: Annotated[int, Form()],
@@ -717,32 +924,16 @@ def add_balance(
     amount: Annotated[int, Form()],
     reason: Annotated[str, Form()],
     db: so.Session = Depends(get_db),
+    user: User | None = Depends(current_user),
 ):
-    no_permission = JSONResponse(
-        status_code=status.HTTP_403_FORBIDDEN, content={"message": "No permission"}
-    )
-    token_str = request.cookies.get("token")
-    if not token_str:
-        return no_permission
-
-    token = parse_token(token_str)
-    if not token:
-        return no_permission
-
-    if not token.is_valid():
-        return no_permission
-
-    user_q = sa.select(User).filter_by(username=token.username)
-    user = db.scalars(user_q).one_or_none()
     if not user:
-        return no_permission
+        return no_permission_response()
     if user.role != Roles.ADMIN and user.role != Roles.METHODIST:
-        return no_permission
+        return no_permission_response()
 
-    wallet_q = sa.select(Wallet).filter_by(squad_id=squad_id)
-    wallet = db.scalars(wallet_q).one_or_none()
+    wallet = db.scalars(WALLET_BY_SQUAD_Q, {"squad_id": squad_id}).one_or_none()
     if not wallet:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"message": "Состав не найден"},
         )
@@ -760,14 +951,15 @@ def add_balance(
             withdrawal.execute()
 
         db.commit()
-        return JSONResponse(
+        invalidate_page_cache()
+        return ORJSONResponse(
             status_code=status.HTTP_201_CREATED,
             content={
                 "message": f"Баланс {squad_id} отряда успешно обновлен ({old_balance} -> {wallet.current_balance})"
             },
         )
     except ValueError as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST, content={"message": str(e)}
         )
 
@@ -787,10 +979,27 @@ def page_not_found(request: Request, exc: HTTPException):
     )
 
 
-@app.get(path="/favicon.ico", response_class=FileResponse, include_in_schema=False)
+# иконка крошечная и не меняется — читаем её в память один раз на старте,
+# чтобы не делать open/stat на каждый запрос
+FAVICON_BYTES = Path("static/favicon.ico").read_bytes()
+
+
+@app.get(path="/favicon.ico", include_in_schema=False)
 async def icon():
-    return FileResponse("static/favicon.ico")
+    return Response(
+        content=FAVICON_BYTES,
+        media_type="image/x-icon",
+        headers={"Cache-Control": "public, max-age=604800"},
+    )
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="192.168.2.157", port=80, reload=True)
+    # reload=True держит file-watcher и принудительно один воркер;
+    # по умолчанию поднимаем по воркеру на ядро, DEV=1 возвращает автоперезапуск
+    uvicorn.run(
+        "main:app",
+        host="192.168.2.157",
+        port=80,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        reload=os.getenv("DEV") == "1",
+    )
@@ -27,7 +27,7 @@ class Squad(Base):
     __tablename__ = "squads"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    number: Mapped[int] = mapped_column(Integer, nullable=False)
+    number: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
     name: Mapped[str] = mapped_column(String(100))
     age_group_id: Mapped[int] = mapped_column(
         ForeignKey("age_groups.id"), nullable=False
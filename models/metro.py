@@ -17,7 +17,7 @@ class Line(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     order_number: Mapped[int] = mapped_column(Integer, nullable=True)
     name: Mapped[str] = mapped_column(String(100))
-    number: Mapped[str] = mapped_column(String(5))
+    number: Mapped[str] = mapped_column(String(5), index=True)
     short_name: Mapped[str] = mapped_column(String(100), nullable=True)
     full_line_coef: Mapped[float] = mapped_column(default=1.2)
     stations: Mapped[List["Station"]] = relationship("Station", back_populates="line")
@@ -78,7 +78,9 @@ class Station(Base):
     name: Mapped[str] = mapped_column(String(100))
     initial_price: Mapped[int] = mapped_column(Integer)
     line_id: Mapped[int] = mapped_column(ForeignKey("lines.id"))
-    owner_id: Mapped[int] = mapped_column(ForeignKey("squads.id"), nullable=True)
+    owner_id: Mapped[int] = mapped_column(
+        ForeignKey("squads.id"), nullable=True, index=True
+    )
     line: Mapped["Line"] = relationship(back_populates="stations")
     owner: Mapped["Squad"] = relationship(back_populates="stations")
 
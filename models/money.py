@@ -2,8 +2,8 @@ import datetime as dt
 from enum import Enum as PythonEnum
 from typing import TYPE_CHECKING, List, Optional
 
-from sqlalchemy import DateTime, Enum, ForeignKey, Integer, String
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import DateTime, Enum, ForeignKey, Index, Integer, String, func
+from sqlalchemy.orm import Mapped, mapped_column, object_session, relationship
 
 from models.base import Base
 
@@ -18,7 +18,7 @@ class Wallet(Base):
     __tablename__ = "wallets"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    squad_id: Mapped[int] = mapped_column(ForeignKey("squads.id"))
+    squad_id: Mapped[int] = mapped_column(ForeignKey("squads.id"), unique=True)
     squad: Mapped["Squad"] = relationship(back_populates="wallet")
     current_balance: Mapped[int] = mapped_column(Integer)
     transactions: Mapped[List["Transaction"]] = relationship(back_populates="wallet")
@@ -41,6 +41,8 @@ class TransactionStatus(PythonEnum):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    # профиль вожатого фильтрует по wallet_id и status одновременно
+    __table_args__ = (Index("ix_transactions_wallet_status", "wallet_id", "status"),)
     __mapper_args__ = {"polymorphic_on": "type"}
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -48,7 +50,7 @@ class Transaction(Base):
     wallet: Mapped[Wallet] = relationship(back_populates="transactions")
     type: Mapped[TransactionType] = mapped_column(Enum(TransactionType))
     amount: Mapped[int] = mapped_column(Integer)
-    timestamp: Mapped[dt.datetime] = mapped_column(DateTime)
+    timestamp: Mapped[dt.datetime] = mapped_column(DateTime, server_default=func.now())
     reason: Mapped[str] = mapped_column(String(100))
     comment: Mapped[str] = mapped_column(String(250))
     status: Mapped[TransactionStatus] = mapped_column(Enum(TransactionStatus))
@@ -64,11 +66,17 @@ class Transaction(Base):
     ):
         self.wallet = wallet
         self.amount = amount
-        self.timestamp = dt.datetime.now()
         self.reason = reason
         self.status = TransactionStatus.CREATED
         self.made_by = made_by
 
+    def _lock_wallet(self):
+        """Блокирует строку кошелька до конца транзакции (SELECT ... FOR UPDATE),
+        чтобы параллельные операции не теряли обновления баланса."""
+        session = object_session(self)
+        if session is not None and session.is_active:
+            session.refresh(self.wallet, with_for_update=True)
+
     def execute(self):
         self.status = TransactionStatus.FAILED
 
@@ -80,6 +88,7 @@ class Deposit(Transaction):
     id: Mapped[int] = mapped_column(ForeignKey("transactions.id"), primary_key=True)
 
     def execute(self):
+        self._lock_wallet()
         old_balance = self.wallet.current_balance
         self.wallet.current_balance += self.amount
         self.comment = f"Пополнение на сумму {self.amount}. Баланс: {old_balance} -> {self.wallet.current_balance}"
@@ -93,6 +102,7 @@ class Withdrawal(Transaction):
     id: Mapped[int] = mapped_column(ForeignKey("transactions.id"), primary_key=True)
 
     def execute(self):
+        self._lock_wallet()
         if self.amount > self.wallet.current_balance:
             deficit = self.amount - self.wallet.current_balance
             self.comment = f"Списание невозможно. Недостаточно средств. Доступно: {self.wallet.current_balance}, требуется ещё {deficit}."
@@ -123,7 +133,7 @@ class SquadRequest(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     timestamp: Mapped[dt.datetime] = mapped_column(
-        DateTime, default=dt.datetime.now, nullable=False
+        DateTime, server_default=func.now(), nullable=False
     )
     status: Mapped[RequestStatus] = mapped_column(
         Enum(RequestStatus),
@@ -135,7 +145,6 @@ class SquadRequest(Base):
     origin_squad: Mapped["Squad"] = relationship()
 
     def __init__(self, origin_squad: "Squad", type: RequestType):
-        self.timestamp = dt.datetime.now()
         self.status = RequestStatus.CREATED
         self.origin_squad = origin_squad
         self.type = type
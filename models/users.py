@@ -1,9 +1,10 @@
-import random
+import secrets
 from datetime import datetime
 from enum import Enum as PythonEnum
 from typing import TYPE_CHECKING, List, Optional
 
 from sqlalchemy import Enum, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from models.base import Base
@@ -96,10 +97,20 @@ class Camper(User):
 
 class RegisterCode(Base):
     __tablename__ = "register_codes"
-    __table_args__ = (UniqueConstraint("code", name="code_unique"),)
+    __table_args__ = (
+        UniqueConstraint("code", name="code_unique"),
+        # на пару (состав, роль) существует ровно один код —
+        # /get-code опирается на это при повторных запросах
+        UniqueConstraint(
+            "target_squad_id", "target_role", name="squad_role_unique"
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    code: Mapped[str] = mapped_column(String(6), nullable=False)
+    code: Mapped[str] = mapped_column(
+        String(6).with_variant(mysql.CHAR(6, collation="ascii_bin"), "mysql"),
+        nullable=False,
+    )
     created_by_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     created_by: Mapped["User"] = relationship()
     target_squad_id: Mapped[int] = mapped_column(ForeignKey("squads.id"))
@@ -113,7 +124,7 @@ class RegisterCode(Base):
         self.code = self.generate_code()
 
     def generate_code(self):
-        return "".join([str(random.randint(0, 9)) for _ in range(6)])
+        return f"{secrets.randbelow(1_000_000):06d}"
 
 
 class Token: